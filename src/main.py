@@ -1,35 +1,46 @@
-import glob
+import atexit
+import base64
+import bisect
+import io
 import json
 import os
 import signal
+import socket
 import string
+import threading
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from datetime import date
 from pathlib import Path
 from typing import Final
+from urllib.parse import quote
 
 import requests
 from requests import Response
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
 
 import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+from email import policy
+from email.message import EmailMessage, MIMEPart
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Config:
     paperlessngx_url: str = None
     paperlessngx_token: str = None
     paperlessngx_filter_tag_id: str = None
     paperlessngx_filter_document_type_id: str = None
     sevdesk_token: str = None
+    sevdesk_voucher_status: int = None
+    sevdesk_credit_debit: str = None
+    sevdesk_tax_rule_id: int = None
     from_email: str = None
     to_email: str = None
     subject: str = None
@@ -41,16 +52,44 @@ class Config:
     run_interval: int = None
 
     def is_valid(self):
-        required_fields = [
-            self.paperlessngx_url, self.paperlessngx_token, self.sevdesk_token,
-            self.from_email, self.to_email, self.smtp_server, self.smtp_port,
-            self.login, self.password
-        ]
-        return all(required_fields)
+        for name, variable in (('paperlessngx_url', 'PAPERLESSNGX_URL'),
+                               ('paperlessngx_token', 'PAPERLESSNGX_TOKEN')):
+            if not getattr(self, name):
+                logger.error(f"Missing {variable}")
+                return False
+
+        # Documents go to sevDesk either via the REST API (token) or the email autobox (SMTP)
+        if self.sevdesk_token:
+            return True
+
+        for name, variable in (('from_email', 'EMAIL_ACCOUNT'), ('smtp_server', 'SMTP_SERVER'),
+                               ('smtp_port', 'SMTP_PORT'), ('login', 'LOGIN'), ('password', 'PASSWORD')):
+            if not getattr(self, name):
+                logger.error(f"Missing {variable} (required when no SEVDESK_TOKEN is set)")
+                return False
+        return True
 
 
 sevdesk_url: Final[str] = "https://my.sevdesk.de/api/v1"
+download_concurrency: Final[int] = 5
+max_download_attempts: Final[int] = 3
+upload_concurrency: Final[int] = 4
+email_batch_size: Final[int] = 10
+email_size_limit: Final[int] = 10 * 1024 * 1024  # Used when the SMTP server doesn't advertise SIZE
+email_size_headroom: Final[int] = 64 * 1024  # Headers, body text and MIME boundaries
+state_file: Final[Path] = Path("workdir/.state.json")
 last_downloaded_document_id: int = 0
+last_lookup_timestamp: int = 0
+lookup_validators: dict[str, dict[str, str]] = {}
+download_failures: dict[int, int] = {}
+shutdown_requested = threading.Event()
+
+
+def getenv_int(name: str, default: int) -> int:
+    # Unset or empty falls back to the default, anything else must be an integer
+    value = os.getenv(name)
+    return int(value) if value else default
+
 
 try:
     config = Config(
@@ -58,27 +97,62 @@ try:
         paperlessngx_token=os.getenv('PAPERLESSNGX_TOKEN') or "",
         paperlessngx_filter_tag_id=os.getenv('PAPERLESSNGX_FILTER_TAG_ID') or 0,
         paperlessngx_filter_document_type_id=os.getenv('PAPERLESSNGX_FILTER_DOCUMENT_TYPE_ID') or 0,
+        sevdesk_token=os.getenv('SEVDESK_TOKEN') or "",
+        sevdesk_voucher_status=getenv_int('SEVDESK_VOUCHER_STATUS', 50),
+        sevdesk_credit_debit=os.getenv('SEVDESK_CREDIT_DEBIT') or "C",
+        sevdesk_tax_rule_id=getenv_int('SEVDESK_TAX_RULE_ID', 9),
         from_email=os.getenv('EMAIL_ACCOUNT') or "",
         to_email="autobox@sevdesk.email",
         subject="Invoice",
         body="Invoice",
         smtp_server=os.getenv('SMTP_SERVER') or "",
-        smtp_port=int(os.getenv('SMTP_PORT')) or 0,
+        smtp_port=getenv_int('SMTP_PORT', 0),
         login=os.getenv('LOGIN') or "",
         password=os.getenv('PASSWORD') or "",
-        run_interval=int(os.getenv('RUN_INTERVAL')) or 300,
+        run_interval=getenv_int('RUN_INTERVAL', 300) or 300,
     )
 except ValueError as e:
     logger.error(f"Error parsing environment variables: {e}")
     exit(1)
 
 
-def paperlessngx_get(path: str) -> Response:
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    # The urllib3 defaults already set TCP_NODELAY; keep them and add TCP keep-alive
+    # so idle pooled connections are not silently dropped between polls
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        ]
+        super().init_poolmanager(*args, **kwargs)
+
+
+def create_session(authorization: str, pool_maxsize: int) -> requests.Session:
+    # One pooled keep-alive session per host, reused for the whole lifetime of the
+    # worker so every request after the first skips the TCP/TLS handshake.
+    session = requests.Session()
+    adapter = KeepAliveHTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["Authorization"] = authorization
+    session.headers["Connection"] = "keep-alive"
+    atexit.register(session.close)
+    return session
+
+
+# Built once, the per-request work is a single concatenation with the api path
+paperlessngx_base_url: Final[str] = config.paperlessngx_url.rstrip("/")
+_session = create_session(f"Token {config.paperlessngx_token}", pool_maxsize=download_concurrency)
+_sevdesk_session = create_session(config.sevdesk_token, pool_maxsize=upload_concurrency)
+
+
+def paperlessngx_get(path: str, stream: bool = False, headers: dict[str, str] = None) -> Response:
     try:
-        response = requests.get(
-            config.paperlessngx_url + path,
+        response = _session.get(
+            paperlessngx_base_url + path,
             allow_redirects=False,
-            headers={"Authorization": "Token " + config.paperlessngx_token}
+            headers=headers,
+            stream=stream,
+            timeout=(5, 60) if stream else (5, 30)
         )
         response.raise_for_status()
         return response
@@ -90,9 +164,18 @@ def paperlessngx_get(path: str) -> Response:
 def paperlessngx_lookup_new_documents():
     global last_downloaded_document_id
 
-    lookup_url = ("/api/documents/?query=added:%5B-1%20week%20to%20now%5D" +
+    lookup_started = int(time.time())
+    added_since = "-1 week"
+    if last_lookup_timestamp:
+        # Start a day before the last complete lookup so documents added around midnight are not missed
+        added_since = date.fromtimestamp(last_lookup_timestamp - 86400).isoformat()
+
+    lookup_url = ("/api/documents/?query=" + quote(f"added:[{added_since} to now]") +
                   "&sort=created" +
-                  "&reverse=1")
+                  "&reverse=1" +
+                  # Only the "all" id list is used, keep the result page tiny
+                  "&page_size=1" +
+                  "&fields=id")
 
     if config.paperlessngx_filter_tag_id:
         lookup_url += "&tags__id__all=" + config.paperlessngx_filter_tag_id
@@ -100,64 +183,305 @@ def paperlessngx_lookup_new_documents():
     if config.paperlessngx_filter_document_type_id:
         lookup_url += "&document_type__id__in=" + config.paperlessngx_filter_document_type_id
 
-    response = paperlessngx_get(lookup_url)
-    if not response:
+    # Conditional request: an unchanged document list is answered with a bodiless 304
+    response = paperlessngx_get(lookup_url, headers=lookup_validators.get(lookup_url))
+    if not response or response.status_code == 304:
         return
 
-    data = json.loads(response.content)
-    new_document_ids = sorted(data['all'])
+    new_document_ids = sorted(response.json()['all'])
     if last_downloaded_document_id == 0:
         if new_document_ids:
             last_downloaded_document_id = new_document_ids[-1]
+        save_state(lookup_started)
+        remember_lookup_validators(lookup_url, response)
         return
 
-    for current_document_id in new_document_ids:
-        if current_document_id <= last_downloaded_document_id:
-            continue
+    pending_document_ids = new_document_ids[bisect.bisect_right(new_document_ids, last_downloaded_document_id):]
+    if pending_document_ids:
+        Path("workdir").mkdir(parents=True, exist_ok=True)  # Ensure directory exists
+
+    # Each worker writes its download to disk itself, so file I/O overlaps with the other transfers
+    with ThreadPoolExecutor(max_workers=download_concurrency) as executor:
+        results = executor.map(paperlessngx_download_document, pending_document_ids)
+        failed = False
+        for current_document_id, downloaded in zip(pending_document_ids, results):
+            if downloaded:
+                download_failures.pop(current_document_id, None)
+                if failed:
+                    # Everything after a failed id is fetched again next time, drop it so it isn't uploaded twice
+                    Path(f"workdir/{current_document_id}.pdf").unlink(missing_ok=True)
+                    continue
+            else:
+                attempts = download_failures.get(current_document_id, 0) + 1
+                download_failures[current_document_id] = attempts
+                if failed or attempts < max_download_attempts:
+                    failed = True
+                    continue
+                # Don't let one broken document hold back every later one
+                logger.error(f"Skipping document {current_document_id} after {attempts} failed downloads")
+                del download_failures[current_document_id]
 
-        logger.info(f"Downloading {current_document_id}")
-        response = paperlessngx_get(f"/api/documents/{current_document_id}/download/")
-        if response:
-            file = Path(f"workdir/{current_document_id}.pdf")
-            file.parent.mkdir(parents=True, exist_ok=True)  # Ensure directory exists
-            file.write_bytes(response.content)
             last_downloaded_document_id = current_document_id
+            save_state()
+
+    # The high-water mark stops before the first failed id, so failed downloads are retried
+    # (up to max_download_attempts); only skip an unchanged list once everything is fetched
+    if last_downloaded_document_id >= max(new_document_ids, default=0):
+        save_state(lookup_started)  # Narrows the next lookup window, even when nothing was new
+        remember_lookup_validators(lookup_url, response)
+
+
+def remember_lookup_validators(lookup_url: str, response: Response):
+    validators = {}
+    if "ETag" in response.headers:
+        validators["If-None-Match"] = response.headers["ETag"]
+    if "Last-Modified" in response.headers:
+        validators["If-Modified-Since"] = response.headers["Last-Modified"]
+
+    lookup_validators.clear()  # The lookup url changes with the window, keep only the latest
+    if validators:
+        lookup_validators[lookup_url] = validators
+
+
+def load_state():
+    global last_downloaded_document_id, last_lookup_timestamp
+
+    try:
+        state = json.loads(state_file.read_text())
+        last_id, last_ts = int(state["last_id"]), int(state["last_ts"])
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.error(f"Ignoring invalid state file {state_file}: {e}")
+        return
+
+    last_downloaded_document_id, last_lookup_timestamp = last_id, last_ts
+
+
+def save_state(lookup_timestamp: int = 0):
+    global last_lookup_timestamp
+
+    if lookup_timestamp:
+        last_lookup_timestamp = lookup_timestamp
+    try:
+        state_file.parent.mkdir(parents=True, exist_ok=True)  # Ensure directory exists
+        temp_file = state_file.with_suffix(".tmp")
+        temp_file.write_text(json.dumps({
+            "last_id": last_downloaded_document_id,
+            "last_ts": last_lookup_timestamp,
+        }))
+        os.replace(temp_file, state_file)
+    except OSError as e:
+        # The in-memory state stays correct, only a restart would fall back to older state
+        logger.error(f"Error writing state file {state_file}: {e}")
+
+
+def paperlessngx_download_document(document_id: int) -> bool:
+    logger.info(f"Downloading {document_id}")
+    response = paperlessngx_get(f"/api/documents/{document_id}/download/", stream=True)
+    if not response:
+        return False
+
+    file = Path(f"workdir/{document_id}.pdf")
+    partial_file = file.with_suffix(".pdf.part")  # Not picked up by the upload until complete
+    try:
+        with response, open(partial_file, "wb") as f:
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                f.write(chunk)
+        os.replace(partial_file, file)
+        return True
+    except (requests.RequestException, OSError) as e:
+        logger.error(f"Error downloading {document_id} from Paperless NGX: {e}")
+        partial_file.unlink(missing_ok=True)
+        return False
 
 
 def send_workdir_to_sevdesk():
-    for file in glob.glob("workdir/*.pdf"):
-        logger.info(f"Uploading {file}")
-        if send_email_with_attachment(file):
+    try:
+        with os.scandir("workdir") as entries:
+            files = sorted(e.path for e in entries if e.name.endswith(".pdf") and e.is_file(follow_symlinks=False))
+    except FileNotFoundError:
+        return
+    if not files:
+        return
+
+    if config.sevdesk_token:
+        with ThreadPoolExecutor(max_workers=upload_concurrency) as executor:
+            list(executor.map(upload_file, files))
+        return
+
+    # The first connection tells the size limit, and then sends the first share itself
+    server = smtp_connect()
+    if not server:
+        logger.error(f"Failed to upload {', '.join(files)}")
+        return
+
+    # Several documents per email, so the SMTP dialog is paid once per batch
+    batches = split_into_email_batches(files, smtp_size_limit(server))
+    # smtplib connections are not thread-safe, so every worker sends its share over its own connection
+    shares = [batches[i::upload_concurrency] for i in range(min(upload_concurrency, len(batches)))]
+    servers = [server] + [None] * (len(shares) - 1)
+    with ThreadPoolExecutor(max_workers=len(shares)) as executor:
+        list(executor.map(email_batches, servers, shares))
+
+
+def upload_file(file: str):
+    logger.info(f"Uploading {file}")
+    if sevdesk_upload_file(file):
+        os.unlink(file)
+    else:
+        logger.error(f"Failed to upload {file}")
+
+
+def email_batches(server: smtplib.SMTP, batches: list[list[str]]):
+    try:
+        for batch in batches:
+            server, sent = email_batch(server, batch)
+            if not sent and len(batch) > 1:
+                # Retry one by one, so a single rejected file can't hold back the others
+                for file in batch:
+                    server, _ = email_batch(server, [file])
+    finally:
+        smtp_disconnect(server)
+
+
+def email_batch(server: smtplib.SMTP, batch: list[str]) -> tuple[smtplib.SMTP, bool]:
+    logger.info(f"Uploading {', '.join(batch)}")
+    server = smtp_ensure_connected(server)
+    if server and send_email_with_attachments(server, batch):
+        for file in batch:
             os.unlink(file)
-        else:
-            logger.error(f"Failed to upload {file}")
+        return server, True
+
+    logger.error(f"Failed to upload {', '.join(batch)}")
+    return server, False
+
+
+def smtp_size_limit(server: smtplib.SMTP) -> int:
+    # The SIZE extension announces the largest accepted message, 0 means no fixed limit
+    size = server.esmtp_features.get("size", "")
+    if size.isdigit() and int(size) > 0:
+        return int(size)
+    return email_size_limit
+
+
+def split_into_email_batches(files: list[str], size_limit: int) -> list[list[str]]:
+    batches, batch, batch_size = [], [], email_size_headroom
+    for file in files:
+        size = base64_encoded_size(os.path.getsize(file))
+        if batch and (len(batch) == email_batch_size or batch_size + size > size_limit):
+            batches.append(batch)
+            batch, batch_size = [], email_size_headroom
+        batch.append(file)
+        batch_size += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def base64_encoded_size(size: int) -> int:
+    # 4 characters per 3 bytes, in lines of 76 characters plus CRLF
+    characters = 4 * ((size + 2) // 3)
+    return characters + 2 * ((characters + 75) // 76)
+
+
+def sevdesk_upload_file(path: str) -> bool:
+    try:
+        with open(path, "rb") as f:
+            response = _sevdesk_session.post(
+                sevdesk_url + "/Voucher/Factory/uploadTempFile",
+                files={"file": (os.path.basename(path), f, "application/pdf")},
+                timeout=(5, 60)
+            )
+        response.raise_for_status()
+        filename = response.json()["objects"]["filename"]
+
+        # Create a voucher for the uploaded file; status, direction and tax rule come from the config
+        response = _sevdesk_session.post(
+            sevdesk_url + "/Voucher/Factory/saveVoucher",
+            json={
+                "voucher": {
+                    "objectName": "Voucher",
+                    "mapAll": True,
+                    "status": config.sevdesk_voucher_status,
+                    "creditDebit": config.sevdesk_credit_debit,
+                    "voucherType": "VOU",
+                    "taxRule": {"id": config.sevdesk_tax_rule_id, "objectName": "TaxRule"},
+                },
+                "filename": filename,
+            },
+            timeout=(5, 30)
+        )
+        response.raise_for_status()
+        return True
+    except (requests.RequestException, OSError, ValueError, KeyError, TypeError) as e:
+        logger.error(f"Error uploading to sevDesk: {e}")
+        return False
+
 
+class NoDelaySMTP(smtplib.SMTP):
+    # SMTP is a dialog of small writes, don't let Nagle delay them
+    def _get_socket(self, host, port, timeout):
+        sock = super()._get_socket(host, port, timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
 
-def send_email_with_attachment(attachment_path):
-    msg = MIMEMultipart()
+
+def smtp_connect() -> smtplib.SMTP:
+    try:
+        server = NoDelaySMTP(config.smtp_server, config.smtp_port)
+        server.starttls()
+        server.login(config.login, config.password)
+        return server
+    except Exception as e:
+        logger.error(f"Failed to connect to SMTP server: {e}")
+        return None
+
+
+def smtp_ensure_connected(server: smtplib.SMTP) -> smtplib.SMTP:
+    if server:
+        try:
+            if server.noop()[0] == 250:
+                return server
+        except (smtplib.SMTPException, OSError):
+            pass
+        smtp_disconnect(server)
+    return smtp_connect()
+
+
+def smtp_disconnect(server: smtplib.SMTP):
+    if not server:
+        return
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+
+def send_email_with_attachments(server: smtplib.SMTP, attachment_paths):
+    # The SMTP policy lets send_message serialize straight to bytes with CRLF line endings
+    msg = EmailMessage(policy=policy.SMTP)
     msg['From'] = config.from_email
     msg['To'] = config.to_email
     msg['Subject'] = config.subject
 
-    msg.attach(MIMEText(config.body, 'plain'))
+    msg.set_content(config.body)
+    msg.make_mixed()
 
     try:
-        with open(attachment_path, "rb") as attachment:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(attachment.read())
-            encoders.encode_base64(part)
-            part.add_header('Content-Disposition', f'attachment; filename={os.path.basename(attachment_path)}')
+        for attachment_path in attachment_paths:
+            part = MIMEPart(policy=policy.SMTP)
+            part['Content-Type'] = 'application/pdf'
+            part['Content-Transfer-Encoding'] = 'base64'
+            part.add_header('Content-Disposition', 'attachment', filename=os.path.basename(attachment_path))
+            part.set_payload(encode_base64_file(attachment_path))
             msg.attach(part)
     except Exception as e:
         logger.error(f"Failed to attach file: {e}")
         return False
 
     try:
-        server = smtplib.SMTP(config.smtp_server, config.smtp_port)
-        server.starttls()
-        server.login(config.login, config.password)
-        server.sendmail(config.from_email, config.to_email, msg.as_string())
-        server.quit()
+        server.send_message(msg)
         logger.info("Email sent successfully!")
         return True
     except Exception as e:
@@ -165,9 +489,19 @@ def send_email_with_attachment(attachment_path):
         return False
 
 
+def encode_base64_file(path) -> str:
+    # Encode chunk by chunk instead of reading the whole file first; chunks are
+    # a multiple of 57 bytes so every chunk ends on a full 76 character line.
+    encoded = io.BytesIO()
+    with open(path, "rb") as f:
+        while chunk := f.read(57 * 1024):
+            encoded.write(base64.encodebytes(chunk))
+    return encoded.getvalue().decode('ascii')
+
+
 def graceful_shutdown(signum, frame):
     logger.info("Received shutdown signal. Exiting...")
-    exit(0)
+    shutdown_requested.set()
 
 
 def main():
@@ -179,13 +513,17 @@ def main():
         logger.error("You need to at least specify the following environment variables:")
         logger.error("- PAPERLESSNGX_URL")
         logger.error("- PAPERLESSNGX_TOKEN")
-        logger.error("- SEVDESK_TOKEN")
+        logger.error("- SEVDESK_TOKEN (or EMAIL_ACCOUNT, SMTP_SERVER, SMTP_PORT, LOGIN and PASSWORD)")
         exit(1)
 
-    while True:
+    load_state()
+
+    while not shutdown_requested.is_set():
+        started = time.monotonic()
         paperlessngx_lookup_new_documents()
         send_workdir_to_sevdesk()
-        time.sleep(config.run_interval)
+        # Wait for the rest of the interval, so runs start on a fixed cadence; a shutdown signal ends the wait
+        shutdown_requested.wait(max(0.0, config.run_interval - (time.monotonic() - started)))
 
 
 if __name__ == '__main__':